@@ -1,5 +1,5 @@
 import logging
-from server import daily_report, load_companies
+from server import daily_report
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,7 +11,6 @@ logger = logging.getLogger(__name__)
 def main():
     logger.info("Cron started")
 
-    load_companies(force=True)
     daily_report()
 
     logger.info("Cron finished")
@@ -0,0 +1,9 @@
+-- Indexes backing the queries in server.py.
+-- CONCURRENTLY cannot run inside a transaction block; run with psql -f.
+
+-- daily_report: today's leads per company, as a range on created_at.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS company_leads_company_created_idx
+    ON company_leads (company_id, created_at DESC);
+
+-- Superseded by company_leads_company_created_idx.
+DROP INDEX CONCURRENTLY IF EXISTS company_leads_company_day_idx;
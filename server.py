@@ -3,12 +3,23 @@ from flask_mail import Mail, Message
 from flask_limiter import Limiter
 from flask_cors import CORS
 # from apscheduler.schedulers.background import BackgroundScheduler
-from psycopg2 import connect, OperationalError
+from psycopg import OperationalError
+from psycopg.rows import namedtuple_row
+from psycopg.types.json import Jsonb, set_json_dumps
+from psycopg_pool import ConnectionPool, PoolTimeout
 # from datetime import date
 from dotenv import load_dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
-from collections import namedtuple
-import os, json, csv, time, hmac, hashlib, requests, logging, io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby, chain
+from operator import itemgetter
+import orjson
+import os, csv, time, hmac, hashlib, requests, logging, io, threading, queue, atexit
 from datetime import date, datetime
 
 
@@ -76,99 +87,221 @@ def limiter_key():
         or request.remote_addr
     )
 
-limiter = Limiter(app=app, key_func=limiter_key)
+# Shared across gunicorn workers via Redis; falls back to per-process
+# memory when REDIS_URL is unset (local runs).
+limiter = Limiter(
+    app=app,
+    key_func=limiter_key,
+    storage_uri=os.getenv("REDIS_URL", "memory://"),
+    strategy="moving-window",
+)
+
+# ==============================
+# BACKGROUND THREADS
+# ==============================
+# Threads don't survive fork, so each gunicorn worker starts its own on
+# first use; DAEMONS remembers which pid started each one.
+DAEMONS = {}
+DAEMONS_LOCK = threading.Lock()
+
+def ensure_daemon(name, target):
+    pid = os.getpid()
+    if DAEMONS.get(name) != pid:
+        with DAEMONS_LOCK:
+            if DAEMONS.get(name) != pid:
+                threading.Thread(target=target, name=name, daemon=True).start()
+                DAEMONS[name] = pid
 
 # ==============================
 # DATABASE (Neon-safe)
 # ==============================
-def get_db():
-    try:
-        return connect(
-            os.getenv("NEON_DATABASE_URL"),
-            connect_timeout=5,
-            sslmode="require",
-            application_name="mysqft-leads",
-        )
-    except OperationalError as e:
-        logger.error("DB connection failed: %s", e)
-        return None
+# Jsonb parameters, i.e. queued leads, are serialized with orjson.
+set_json_dumps(orjson.dumps)
+
+# The pool is created lazily and re-created when the pid changes, so
+# gunicorn workers forked from a preloaded master never share sockets.
+POOL = None
+POOL_PID = None
+POOL_LOCK = threading.Lock()
+
+def get_pool():
+    global POOL, POOL_PID
+    with POOL_LOCK:
+        if POOL is None or POOL_PID != os.getpid():
+            POOL = ConnectionPool(
+                os.getenv("NEON_DATABASE_URL"),
+                min_size=2,
+                max_size=int(os.getenv("PG_POOL_MAX", 10)),
+                kwargs={
+                    "connect_timeout": 5,
+                    "sslmode": "require",
+                    "application_name": "mysqft-leads",
+                },
+                # Neon drops idle connections; never hand a dead one back out.
+                check=ConnectionPool.check_connection,
+                timeout=10,
+                open=True,
+            )
+            POOL_PID = os.getpid()
+        return POOL
+
+@contextmanager
+def db_conn():
+    # Commits on success, rolls back on error, returns the connection.
+    with get_pool().connection() as conn:
+        yield conn
 
 # ==============================
 # COMPANY CACHE
 # ==============================
-Company = namedtuple(
-    "Company",
-    "id name email discord webhook_url webhook_secret plan expiry fields"
-)
-
+# /submit only ever reads COMPANY_CACHE. A per-process refresher thread
+# builds a fresh dict every CACHE_TTL seconds and rebinds the name, so
+# readers never see a half-built cache and never hit the database.
 COMPANY_CACHE = {}
 CACHE_TTL = 300
+CACHE_READY = threading.Event()
 LAST_LOAD = 0
 
 def load_companies(force=False):
-    global LAST_LOAD
+    global COMPANY_CACHE, LAST_LOAD
     if not force and time.time() - LAST_LOAD < CACHE_TTL:
-        return
-
-    conn = get_db()
-    if not conn:
-        return
+        return True
 
+    cache = {}
     try:
-        with conn.cursor() as cur:
+        # Rows come back as namedtuples whose fields are the column aliases
+        # below; /submit reads them as company.name, company.expiry, ...
+        with db_conn() as conn, conn.cursor(row_factory=namedtuple_row) as cur:
             cur.execute("""
-                SELECT subdomain, id, company_name, email,
-                       discord_webhook, webhook_url, webhook_secret,
-                       plan, plan_expiry, lead_fields
+                SELECT subdomain, id, company_name AS name, email,
+                       discord_webhook AS discord, webhook_url, webhook_secret,
+                       plan, plan_expiry AS expiry, lead_fields AS fields
                 FROM companies
                 WHERE is_active=true
-            """)
-            COMPANY_CACHE.clear()
-            for row in cur.fetchall():
-                COMPANY_CACHE[row[0]] = Company(*row[1:])
-        LAST_LOAD = time.time()
-        logger.info("Loaded %d companies", len(COMPANY_CACHE))
-    finally:
-        conn.close()
+            """, prepare=True)
+            for company in cur:
+                cache[company.subdomain] = company
+    except (OperationalError, PoolTimeout) as e:
+        logger.error("DB connection failed: %s", e)
+        return False
+
+    COMPANY_CACHE = cache
+    LAST_LOAD = time.time()
+    CACHE_READY.set()
+    logger.info("Loaded %d companies", len(cache))
+    return True
+
+def _refresh_loop():
+    while True:
+        try:
+            loaded = load_companies(force=True)
+        except Exception:
+            # Never let the thread die: nothing else would refresh the cache.
+            logger.exception("Company cache refresh failed")
+            loaded = False
+        # After a failed load, retry shortly rather than a full TTL later.
+        time.sleep(CACHE_TTL if loaded else 5)
 
 # ==============================
 # HELPERS
 # ==============================
 def resolve_subdomain():
-    host = request.headers.get("X-Forwarded-Host", request.host).split(":")[0]
-    if host.endswith(".mysqft.in"):
-        return host.replace(".mysqft.in", "")
-    return "mysqft"
+    host = (request.headers.get("X-Forwarded-Host") or request.host).partition(":")[0]
+    sub = host.removesuffix(".mysqft.in")
+    return sub if sub != host and sub and sub != "www" else "mysqft"
+
+# The date is only re-read once a minute, timed on the monotonic clock so
+# a wall-clock step backwards can't pin yesterday's date past midnight.
+_TODAY = [date.today(), time.monotonic()]
+
+def today():
+    now = time.monotonic()
+    if now - _TODAY[1] > 60:
+        _TODAY[0] = date.today()
+        _TODAY[1] = now
+    return _TODAY[0]
 
 def days_left(expiry):
-    return (expiry - date.today()).days
+    return expiry.toordinal() - today().toordinal()
 
 # ==============================
 # LEADS
 # ==============================
-def save_lead(company_id, data):
-    conn = get_db()
-    if not conn:
-        return False
-
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO company_leads (company_id, lead_data) VALUES (%s,%s)",
-                (company_id, json.dumps(data)),
-            )
-        conn.commit()
-        return True
-    except Exception as e:
-        logger.error("save_lead error: %s", e)
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
+# /submit only enqueues; a per-process flusher thread writes the queue out
+# in pipelined batches every LEAD_FLUSH_INTERVAL seconds.
+LEAD_QUEUE = queue.Queue()
+LEAD_BATCH = 500
+LEAD_FLUSH_INTERVAL = 0.05
+
+LEAD_RETRIES = 3
+
+def save_leads_batch(rows):
+    for attempt in range(LEAD_RETRIES):
+        try:
+            with db_conn() as conn, conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO company_leads (company_id, lead_data) VALUES (%s,%s)",
+                    rows,
+                )
+            return True
+        except (OperationalError, PoolTimeout) as e:
+            # A connection blip; the rows themselves are fine.
+            error = e
+            time.sleep(0.2 * 2 ** attempt)
+        except Exception as e:
+            # A bad row (e.g. a company deleted since the last cache refresh)
+            # must not take the rest of the batch down with it.
+            if len(rows) == 1:
+                logger.error("save_lead error (lead for company %s dropped): %s", rows[0][0], e)
+                return False
+            return all([save_leads_batch([row]) for row in rows])
+
+    logger.error("save_leads_batch error (%d leads dropped): %s", len(rows), error)
+    return False
+
+def _flush_loop():
+    while True:
+        rows = [LEAD_QUEUE.get()]
+        deadline = time.monotonic() + LEAD_FLUSH_INTERVAL
+        while len(rows) < LEAD_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(LEAD_QUEUE.get(timeout=timeout))
+            except queue.Empty:
+                break
+        save_leads_batch(rows)
+
+def flush_leads():
+    rows = []
+    while True:
+        try:
+            rows.append(LEAD_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        save_leads_batch(rows)
+
+atexit.register(flush_leads)
+
+def queue_lead(company_id, data):
+    ensure_daemon("lead-flusher", _flush_loop)
+    LEAD_QUEUE.put((company_id, Jsonb(data)))
 
 # ==============================
 # NOTIFICATIONS
 # ==============================
+# Shared session so Discord and webhook POSTs reuse open TLS connections.
+HTTP = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+)
+HTTP.mount("https://", _adapter)
+HTTP.mount("http://", _adapter)
+
 def send_email(to, csv_content, expiry):
     dleft = days_left(expiry)
 
@@ -190,23 +323,26 @@ def send_email(to, csv_content, expiry):
         msg.attach("leads.csv", "text/csv", csv_content)
         mail.send(msg)
 
-def send_discord(webhook, content):
+def send_discord(webhook, embeds):
     if webhook:
-        requests.post(webhook, json={"content": content}, timeout=5)
+        HTTP.post(webhook, json={"embeds": embeds}, timeout=5).raise_for_status()
+
+@lru_cache(maxsize=1024)
+def hmac_template(secret):
+    # Keyed once per secret; send_webhook only copies the template.
+    return hmac.new(secret.encode(), None, hashlib.sha256)
 
 def send_webhook(url, secret, payload):
     if not url or not secret:
         return
 
-    body = json.dumps(payload)
+    body = orjson.dumps(payload)
     timestamp = str(int(time.time()))
-    signature = hmac.new(
-        secret.encode(),
-        (timestamp + body).encode(),
-        hashlib.sha256,
-    ).hexdigest()
+    h = hmac_template(secret).copy()
+    h.update(timestamp.encode() + body)
+    signature = h.hexdigest()
 
-    requests.post(
+    HTTP.post(
         url,
         data=body,
         headers={
@@ -215,51 +351,237 @@ def send_webhook(url, secret, payload):
             "X-Timestamp": timestamp,
         },
         timeout=5,
+    ).raise_for_status()
+
+# Deliveries run on NOTIFY_POOL so /submit never waits on Discord or a
+# customer endpoint. After BREAKER_FAILURES failures in a row a URL is
+# skipped for BREAKER_COOLDOWN seconds, then probed with a single trial.
+NOTIFY_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="notify")
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+FAILURES = defaultdict(lambda: deque(maxlen=BREAKER_FAILURES))
+BREAKER_LOCK = threading.Lock()
+
+def _deliver(send, url, *args):
+    try:
+        send(url, *args)
+    except Exception as e:
+        with BREAKER_LOCK:
+            FAILURES[url].append(time.time())
+        # The URL itself is a credential for Discord, and requests puts it
+        # in its exception messages; log only the error type and status.
+        status = e.response.status_code if isinstance(e, requests.HTTPError) else None
+        logger.error("%s failed: %s %s", send.__name__, type(e).__name__, status or "")
+    else:
+        with BREAKER_LOCK:
+            FAILURES.pop(url, None)
+
+def notify(send, url, *args):
+    if not url:
+        return
+    with BREAKER_LOCK:
+        failures = FAILURES.get(url)
+        if failures and len(failures) == BREAKER_FAILURES:
+            if time.time() - failures[-1] < BREAKER_COOLDOWN:
+                return
+            # Half-open: let this one delivery through as a trial and re-arm
+            # the cooldown so everything behind it waits for the outcome.
+            failures.append(time.time())
+    NOTIFY_POOL.submit(_deliver, send, url, *args)
+
+# Leads for the same Discord webhook are held for DISCORD_WINDOW seconds
+# and posted together as embeds. Discord allows 10 embeds and 6000
+# characters per message, and rate-limits each webhook URL.
+DISCORD_WINDOW = 1.5
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_CHARS = 6000
+DISCORD_BUFFER = defaultdict(list)
+DISCORD_LOCK = threading.Lock()
+
+def discord_embed(company, lead):
+    embed = {
+        "title": f"📩 New Lead for {company.name}"[:256],
+        "fields": [
+            {"name": str(k)[:256], "value": str(v)[:1024]}
+            for k, v in list(lead.items())[:25]
+        ],
+    }
+    dleft = days_left(company.expiry)
+    if 0 <= dleft < 3:
+        embed["footer"] = {"text": f"⚠️ Plan expires in {dleft} day(s) — please renew."}
+
+    # One embed must fit a message on its own: trim values from the last
+    # field backwards, then drop whole fields if the names alone are over.
+    overflow = _embed_size(embed) - DISCORD_MAX_CHARS
+    for field in reversed(embed["fields"]):
+        if overflow <= 0:
+            break
+        cut = min(overflow, len(field["value"]) - 1)
+        field["value"] = field["value"][:len(field["value"]) - cut]
+        overflow -= cut
+    while overflow > 0 and embed["fields"]:
+        field = embed["fields"].pop()
+        overflow -= len(field["name"]) + len(field["value"])
+    return embed
+
+def _embed_size(embed):
+    return (
+        len(embed["title"])
+        + sum(len(f["name"]) + len(f["value"]) for f in embed["fields"])
+        + len(embed.get("footer", {}).get("text", ""))
     )
 
+def queue_discord(webhook, embed):
+    if not webhook:
+        return
+    with DISCORD_LOCK:
+        pending = DISCORD_BUFFER[webhook]
+        pending.append(embed)
+        if len(pending) == 1:
+            timer = threading.Timer(DISCORD_WINDOW, flush_discord, (webhook,))
+            timer.daemon = True
+            timer.start()
+
+def _discord_batches(embeds):
+    batch, size = [], 0
+    for embed in embeds:
+        n = _embed_size(embed)
+        if batch and (len(batch) == DISCORD_MAX_EMBEDS or size + n > DISCORD_MAX_CHARS):
+            yield batch
+            batch, size = [], 0
+        batch.append(embed)
+        size += n
+    if batch:
+        yield batch
+
+def flush_discord(webhook):
+    with DISCORD_LOCK:
+        embeds = DISCORD_BUFFER.pop(webhook, [])
+    for batch in _discord_batches(embeds):
+        notify(send_discord, webhook, batch)
+
+def flush_all_discord():
+    # NOTIFY_POOL no longer accepts work at exit, so deliver inline.
+    with DISCORD_LOCK:
+        pending = dict(DISCORD_BUFFER)
+        DISCORD_BUFFER.clear()
+    for webhook, embeds in pending.items():
+        for batch in _discord_batches(embeds):
+            _deliver(send_discord, webhook, batch)
+
+atexit.register(flush_all_discord)
+
 # ==============================
 # DAILY REPORT
 # ==============================
+def build_csv(headers, rows):
+    # Lead values are short form inputs that almost never need quoting, so
+    # lines are joined directly and only routed through csv.writer when one
+    # does. Each line is encoded as it is written; the report is never held
+    # as one str on its way into the attachment.
+    width = len(headers)
+    buf = io.BytesIO()
+    quoted = io.StringIO()
+    writer = csv.writer(quoted)
+
+    def write(cells):
+        line = ",".join(cells)
+        if line.count(",") != width or '"' in line or "\n" in line or "\r" in line:
+            quoted.seek(0)
+            quoted.truncate()
+            writer.writerow(cells)
+            buf.write(quoted.getvalue().encode())
+        else:
+            buf.write(line.encode())
+            buf.write(b"\r\n")
+
+    write(headers + ["created_at"])
+    for data, ts in rows:
+        cells = [str(data.get(h, "")) for h in headers]
+        cells.append(str(ts))
+        write(cells)
+    return buf.getvalue()
+
+REPORT_WORKERS = 8
+PURGE_BATCH = 1000
+
+def purge_leads(conn, ctids):
+    # Delete exactly the rows the report read, by ctid: a lead that
+    # committed after the report's snapshot is kept whatever its
+    # created_at says. Small committed batches keep row locks short while
+    # /submit keeps inserting.
+    for i in range(0, len(ctids), PURGE_BATCH):
+        conn.execute(
+            "DELETE FROM company_leads WHERE ctid = ANY(%s::tid[])",
+            (ctids[i:i + PURGE_BATCH],),
+        )
+        conn.commit()
+
+def _read_leads(rows, ctids):
+    # (lead_data, created_at) for build_csv, noting each row's ctid.
+    for row in rows:
+        ctids.append(row[7])
+        yield row[5:7]
+
 def daily_report():
     logger.info("Running daily report")
-    conn = get_db()
-    if not conn:
-        return
-
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT id, company_name, email, plan, plan_expiry
-                FROM companies
-                WHERE is_active=true AND plan_expiry >= CURRENT_DATE
-            """)
-            for cid, name, email, plan, expiry in cur.fetchall():
-                cur.execute("""
-                    SELECT lead_data, created_at
-                    FROM company_leads
-                    WHERE company_id=%s AND created_at::date=CURRENT_DATE
-                """, (cid,))
-                rows = cur.fetchall()
-                if not rows:
-                    continue
-
-                headers = sorted({k for r, _ in rows for k in r})
-                buf = io.StringIO()
-                writer = csv.writer(buf)
-                writer.writerow(headers + ["created_at"])
-                for data, ts in rows:
-                    writer.writerow([data.get(h, "") for h in headers] + [ts])
+        with db_conn() as conn:
+            # Rows are read on this thread; SMTP sends, the slow part, run
+            # REPORT_WORKERS at a time while the next company is formatted.
+            # slots caps the reports queued or in flight, so memory stays at
+            # about REPORT_WORKERS CSVs however many companies there are.
+            reported = []
+            sends = {}
+            slots = threading.BoundedSemaphore(REPORT_WORKERS)
+            with ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report") as ex:
+                # Server-side cursor: leads stream in itersize batches instead
+                # of the whole day being fetched into memory at once.
+                with conn.cursor(name="daily_report") as cur:
+                    cur.itersize = 1000
+                    cur.execute("""
+                        SELECT c.id, c.email, c.plan, c.plan_expiry, c.lead_fields,
+                               cl.lead_data, cl.created_at, cl.ctid
+                        FROM companies c
+                        JOIN company_leads cl ON cl.company_id = c.id
+                        WHERE c.is_active=true AND c.plan_expiry >= CURRENT_DATE
+                          AND cl.created_at >= CURRENT_DATE
+                          AND cl.created_at < CURRENT_DATE + INTERVAL '1 day'
+                        ORDER BY c.id
+                    """)
+                    for cid, group in groupby(cur, key=itemgetter(0)):
+                        first = next(group)
+                        _, email, plan, expiry, fields = first[:5]
+                        ctids = []
+
+                        if plan in ("email", "all"):
+                            rows = _read_leads(chain([first], group), ctids)
+                            content = build_csv(list(fields), rows)
+                            slots.acquire()
+                            future = ex.submit(send_email, email, content, expiry)
+                            future.add_done_callback(lambda _: slots.release())
+                            sends[future] = cid, ctids
+                        else:
+                            reported.extend(row[7] for row in chain([first], group))
+
+                # Done reading: end the transaction rather than holding it
+                # open while the last sends finish.
+                conn.commit()
 
-                if plan in ("email", "all"):
-                    send_email(email, buf.getvalue(), expiry)
+            for future, (cid, ctids) in sends.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    # Keep the leads for tomorrow rather than aborting
+                    # the whole run and re-sending everyone else.
+                    logger.error("Report email to company %s failed: %s", cid, e)
+                    continue
+                reported.extend(ctids)
 
-                cur.execute(
-                    "DELETE FROM company_leads WHERE company_id=%s AND created_at::date=CURRENT_DATE",
-                    (cid,),
-                )
-                conn.commit()
-    finally:
-        conn.close()
+            if reported:
+                purge_leads(conn, reported)
+    except (OperationalError, PoolTimeout) as e:
+        logger.error("DB connection failed: %s", e)
 
 # ==============================
 # SCHEDULER (single instance only)
@@ -304,44 +626,31 @@ def timer():
 @app.route("/submit", methods=["POST"])
 @limiter.limit("5 per 10 minutes")
 def submit():
-    sub = resolve_subdomain()
-    company = COMPANY_CACHE.get(sub)
+    ensure_daemon("company-refresher", _refresh_loop)
+    CACHE_READY.wait(timeout=5)
 
-    if not company:
-        load_companies(force=True)
-        company = COMPANY_CACHE.get(sub)
-
-    if not company or company.expiry < date.today():
+    company = COMPANY_CACHE.get(resolve_subdomain())
+    if not company or company.expiry < today():
         return jsonify(error="Unauthorized"), 403
 
-    lead = {f: request.form.get(f) for f in company.fields if request.form.get(f)}
+    form = request.form.to_dict()
+    lead = {f: v for f in company.fields if (v := form.get(f))}
     if not lead:
         return jsonify(error="No valid data"), 400
 
-    if not save_lead(company.id, lead):
-        return jsonify(error="Failed to save lead"), 500
+    queue_lead(company.id, lead)
 
     if company.plan in ("discord", "all"):
-        dleft = days_left(company.expiry)
-
-        msg = (
-            f"📩 **New Lead for {company.name}**\n"
-            + "\n".join(f"**{k}**: {v}" for k, v in lead.items())
-        )
-
-        if 0 <= dleft < 3:
-            msg += f"\n\n⚠️ **Plan expires in {dleft} day(s)** — please renew."
-
-        send_discord(company.discord, msg)
+        queue_discord(company.discord, discord_embed(company, lead))
 
     if company.plan in ("webhook", "all"):
-        send_webhook(company.webhook_url, company.webhook_secret, {
+        notify(send_webhook, company.webhook_url, company.webhook_secret, {
             "event": "lead.created",
             "company": company.name,
             "lead": lead
         })
 
-    return jsonify(message="Send successfully!"), 200
+    return jsonify(message="Send successfully!"), 202
 
 
 